@@ -1,11 +1,25 @@
-import random
+import re
 
 import fastapi
 import gradio as gr
+import numpy as np
 import uvicorn
 
 from viser_proxy_manager import ViserProxyManager
 
+# Filled in with (protocol, host, session hash) for each page load.
+_IFRAME_HTML = (
+    '<div style="border: 2px solid #ccc; padding: 10px;">'
+    '<iframe src="%s://%s/viser/%s/" width="100%%" height="500px" frameborder="0"></iframe>'
+    "</div>"
+)
+
+# Hostname, IPv4, or bracketed IPv6 address, with an optional port. The host header is
+# client-controlled, so we check it before inserting it into the HTML above.
+_HOST_PATTERN = re.compile(r"(?:[A-Za-z0-9.-]+|\[[0-9A-Fa-f:.]+\])(?::\d+)?")
+
+_rng = np.random.default_rng()
+
 
 def main() -> None:
     app = fastapi.FastAPI()
@@ -23,10 +37,13 @@ def main() -> None:
         @demo.load(outputs=[iframe_html])
         def start_server(request: gr.Request):
             assert request.session_hash is not None
-            viser_manager.start_server(request.session_hash)
 
             # Use the request's base URL if available
             host = request.headers["host"]
+            if _HOST_PATTERN.fullmatch(host) is None:
+                raise ValueError(f"Invalid host header: {host!r}")
+
+            viser_manager.start_server(request.session_hash)
 
             # Determine protocol (use HTTPS for HuggingFace Spaces or other secure environments)
             protocol = (
@@ -35,27 +52,25 @@ def main() -> None:
                 else "http"
             )
 
-            return f"""
-            <div style="border: 2px solid #ccc; padding: 10px;">
-                <iframe src="{protocol}://{host}/viser/{request.session_hash}/" width="100%" height="500px" frameborder="0"></iframe>
-            </div>
-            """
+            return _IFRAME_HTML % (protocol, host, request.session_hash)
 
         @add_sphere_btn.click
         def add_random_sphere(request: gr.Request):
             assert request.session_hash is not None
             server = viser_manager.get_server(request.session_hash)
 
-            # Add icosphere with random properties
+            # Add icosphere with random properties. Position, radius, and color are
+            # drawn together: three uniform values in [-1, 1), one in [0.05, 0.2),
+            # and three in [0, 1).
+            values = _rng.uniform(
+                low=(-1.0, -1.0, -1.0, 0.05, 0.0, 0.0, 0.0),
+                high=(1.0, 1.0, 1.0, 0.2, 1.0, 1.0, 1.0),
+            )
             server.scene.add_icosphere(
-                name=f"sphere_{random.randint(1, 10000)}",
-                position=(
-                    random.uniform(-1, 1),
-                    random.uniform(-1, 1),
-                    random.uniform(-1, 1),
-                ),
-                radius=random.uniform(0.05, 0.2),
-                color=(random.random(), random.random(), random.random()),
+                name=f"sphere_{_rng.integers(1, 10000, endpoint=True)}",
+                position=values[:3],
+                radius=float(values[3]),
+                color=values[4:],
             )
 
         @demo.unload
@@ -64,7 +79,11 @@ def main() -> None:
             viser_manager.stop_server(request.session_hash)
 
     gr.mount_gradio_app(app, demo, "/")
-    uvicorn.run(app, host="0.0.0.0", port=7860)
+
+    # uvicorn picks uvloop and httptools automatically when they're installed. This
+    # must stay a single worker process: ViserProxyManager state is process-local, so
+    # scaling out would need sticky routing by session.
+    uvicorn.run(app, host="0.0.0.0", port=7860, timeout_keep_alive=30)
 
 
 if __name__ == "__main__":
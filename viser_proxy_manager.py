@@ -1,10 +1,52 @@
 import asyncio
+import collections
+import logging
+import threading
 
 import httpx
 import viser
 import websockets
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
+from fastapi.websockets import WebSocketState
+from starlette.background import BackgroundTask
+
+logger = logging.getLogger(__name__)
+
+# Hop-by-hop headers only apply to a single connection, so they shouldn't be copied
+# from the upstream Viser response to the downstream one.
+_HOP_BY_HOP_HEADERS = frozenset(
+    {
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailers",
+        "transfer-encoding",
+        "upgrade",
+    }
+)
+
+# Request headers forwarded to the Viser server. Anything else, including host and
+# client-only headers like sec-fetch-*, is dropped. content-length is left out since
+# httpx computes it from the forwarded body.
+_FORWARD_HEADERS = frozenset(
+    {
+        b"accept",
+        b"accept-language",
+        b"authorization",
+        b"cache-control",
+        b"content-type",
+        b"cookie",
+        b"if-modified-since",
+        b"if-none-match",
+        b"origin",
+        b"range",
+        b"referer",
+        b"user-agent",
+    }
+)
 
 
 class ViserProxyManager:
@@ -32,15 +74,37 @@ class ViserProxyManager:
         self._min_port = min_local_port
         self._max_port = max_local_port
         self._server_from_session_hash: dict[str, viser.ViserServer] = {}
-        self._last_port = self._min_port - 1  # Track last port tried
+        self._port_from_session_hash: dict[str, int] = {}
+        # Ports not handed out to any server. Released ports go to the back, so
+        # allocation cycles through the range instead of reusing ports immediately.
+        self._free_ports = collections.deque(range(min_local_port, max_local_port + 1))
+        # Gradio runs synchronous event handlers in worker threads, so servers can be
+        # started and stopped concurrently.
+        self._lock = threading.Lock()
         self._max_websocket_message_size_bytes = max_websocket_message_size_bytes
 
+        # Shared HTTP client for all proxied requests. Creating a client per request
+        # is expensive (SSL context, connection pool setup), and httpx pools
+        # connections per host so every local Viser server can share this one.
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(30.0, connect=2.0),
+            limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        )
+
+        async def close_client() -> None:
+            """Close the shared HTTP client when the application shuts down."""
+            await self._client.aclose()
+
+        # The app is already constructed, so we can't give it a lifespan. Register a
+        # shutdown handler on the router instead (app.on_event() is deprecated).
+        app.router.add_event_handler("shutdown", close_client)
+
         @app.get("/viser/{server_id}/{proxy_path:path}")
         async def proxy(request: Request, server_id: str, proxy_path: str):
             """Proxy HTTP requests to the appropriate Viser server."""
             # Get the local port for this server ID
-            server = self._server_from_session_hash.get(server_id)
-            if server is None:
+            port = self._port_from_session_hash.get(server_id)
+            if port is None:
                 return Response(content="Server not found", status_code=404)
 
             # Build target URL
@@ -49,35 +113,37 @@ class ViserProxyManager:
             else:
                 path_suffix = "/"
 
-            target_url = f"http://127.0.0.1:{server.get_port()}{path_suffix}"
+            target_url = f"http://127.0.0.1:{port}{path_suffix}"
             if request.url.query:
                 target_url += f"?{request.url.query}"
 
+            # Forward only the allowlisted headers
+            headers = [(k, v) for k, v in request.headers.raw if k in _FORWARD_HEADERS]
+            headers.append((b"accept-encoding", b"identity"))  # Disable compression
+
             # Forward request
-            async with httpx.AsyncClient() as client:
-                # Forward the original headers, but remove any problematic ones
-                headers = dict(request.headers)
-                headers.pop("host", None)  # Remove host header to avoid conflicts
-                headers["accept-encoding"] = "identity"  # Disable compression
-
-                proxied_req = client.build_request(
-                    method=request.method,
-                    url=target_url,
-                    headers=headers,
-                    content=await request.body(),
-                )
-                proxied_resp = await client.send(proxied_req, stream=True)
-
-                # Get response headers
-                response_headers = dict(proxied_resp.headers)
-
-                # Check if this is an HTML response
-                content = await proxied_resp.aread()
-                return Response(
-                    content=content,
-                    status_code=proxied_resp.status_code,
-                    headers=response_headers,
-                )
+            proxied_req = self._client.build_request(
+                method=request.method,
+                url=target_url,
+                headers=headers,
+                content=await request.body(),
+            )
+            proxied_resp = await self._client.send(proxied_req, stream=True)
+
+            # Get response headers
+            response_headers = {
+                k: v
+                for k, v in proxied_resp.headers.items()
+                if k not in _HOP_BY_HOP_HEADERS
+            }
+
+            # Stream the body through as it arrives instead of buffering it
+            return StreamingResponse(
+                proxied_resp.aiter_raw(),
+                status_code=proxied_resp.status_code,
+                headers=response_headers,
+                background=BackgroundTask(proxied_resp.aclose),
+            )
 
         # WebSocket Proxy
         @app.websocket("/viser/{server_id}")
@@ -91,13 +157,13 @@ class ViserProxyManager:
                 p.strip() for p in client_subprotocols if len(p.strip()) > 0
             ]
 
-            server = self._server_from_session_hash.get(server_id)
-            if server is None:
+            port = self._port_from_session_hash.get(server_id)
+            if port is None:
                 await websocket.close(code=1008, reason="Not Found")
                 return
 
             # Determine target WebSocket URL
-            target_ws_url = f"ws://127.0.0.1:{server.get_port()}"
+            target_ws_url = f"ws://127.0.0.1:{port}"
             try:
                 # First connect to the target server to determine which subprotocol it selects
                 selected_protocol = None
@@ -109,6 +175,7 @@ class ViserProxyManager:
                             target_ws_url,
                             subprotocols=client_subprotocols,  # type: ignore
                             max_size=self._max_websocket_message_size_bytes,
+                            compression=None,
                         ) as ws:
                             # Get the selected protocol from the server
                             selected_protocol = ws.subprotocol
@@ -122,24 +189,37 @@ class ViserProxyManager:
                 else:
                     await websocket.accept()
 
-                # Establish the main connection to the target server
+                # Establish the main connection to the target server. This is a local
+                # connection, so skip compression (pure CPU cost here) and keepalive
+                # pings; the client connection already handles keepalive.
                 async with websockets.connect(
                     target_ws_url,
                     max_size=self._max_websocket_message_size_bytes,
                     subprotocols=client_subprotocols if client_subprotocols else None,  # type: ignore
+                    compression=None,
+                    ping_interval=None,
                 ) as ws_target:
-                    # Create tasks for bidirectional communication
+                    # Set by whichever forwarder exits first, i.e. once either side closes
+                    close_event = asyncio.Event()
+
                     async def forward_to_target():
                         """Forward messages from the client to the target WebSocket."""
                         try:
+                            # Read raw ASGI messages rather than going through
+                            # receive_bytes(), which wraps this same call per frame.
                             while True:
-                                data = await websocket.receive_bytes()
-                                await ws_target.send(data, text=False)
-                        except WebSocketDisconnect:
-                            try:
-                                await ws_target.close()
-                            except RuntimeError:
-                                pass
+                                message = await websocket.receive()
+                                if message["type"] == "websocket.disconnect":
+                                    break
+                                data = message.get("bytes")
+                                if data is not None:
+                                    await ws_target.send(data, text=False)
+                                else:
+                                    await ws_target.send(message["text"])
+                        except websockets.exceptions.ConnectionClosed:
+                            pass
+                        finally:
+                            close_event.set()
 
                     async def forward_from_target():
                         """Forward messages from the target WebSocket to the client."""
@@ -147,34 +227,50 @@ class ViserProxyManager:
                             while True:
                                 data = await ws_target.recv(decode=False)
                                 await websocket.send_bytes(data)
-                        except websockets.exceptions.ConnectionClosed:
-                            try:
-                                await websocket.close()
-                            except RuntimeError:
-                                pass
-
-                    # Run both forwarding tasks concurrently
-                    forward_task = asyncio.create_task(forward_to_target())
-                    backward_task = asyncio.create_task(forward_from_target())
-
-                    # Wait for either task to complete (which means a connection was closed)
-                    done, pending = await asyncio.wait(
-                        [forward_task, backward_task],
-                        return_when=asyncio.FIRST_COMPLETED,
+                        except (
+                            WebSocketDisconnect,
+                            websockets.exceptions.ConnectionClosed,
+                        ):
+                            pass
+                        finally:
+                            close_event.set()
+
+                    # Run both forwarding tasks concurrently. Once either side closes,
+                    # cancel the remaining task and wait for both to finish, so neither
+                    # is left running after the handler returns.
+                    tasks = (
+                        asyncio.create_task(forward_to_target()),
+                        asyncio.create_task(forward_from_target()),
                     )
-
-                    # Cancel the remaining task
-                    for task in pending:
-                        task.cancel()
+                    try:
+                        await close_event.wait()
+                    finally:
+                        for task in tasks:
+                            task.cancel()
+                        results = await asyncio.gather(*tasks, return_exceptions=True)
+
+                    # Re-raise unexpected errors from the forwarders. Cancellation is a
+                    # BaseException, so it isn't included here.
+                    for result in results:
+                        if isinstance(result, Exception):
+                            raise result
+
+                # The target connection is closed by the context manager above; close
+                # the client connection too if the target was the side that closed.
+                if (
+                    websocket.client_state == WebSocketState.CONNECTED
+                    and websocket.application_state == WebSocketState.CONNECTED
+                ):
+                    await websocket.close()
 
             except Exception as e:
-                print(f"WebSocket proxy error: {e}")
+                logger.warning("WebSocket proxy error: %s", e)
                 await websocket.close(code=1011, reason=str(e))
 
     def start_server(self, server_id: str) -> viser.ViserServer:
         """Start a new Viser server and associate it with the given server ID.
 
-        Finds an available port within the configured min_local_port and max_local_port range.
+        Takes the next free port within the configured min_local_port and max_local_port range.
         These ports are used only for internal communication and don't need to be publicly exposed.
 
         Args:
@@ -188,30 +284,47 @@ class ViserProxyManager:
         """
         import socket
 
-        # Start searching from the last port + 1 (with wraparound)
-        port_range_size = self._max_port - self._min_port + 1
-        start_port = (
-            (self._last_port + 1 - self._min_port) % port_range_size
-        ) + self._min_port
-
-        # Try each port once
-        for offset in range(port_range_size):
-            port = (
-                (start_port - self._min_port + offset) % port_range_size
-            ) + self._min_port
+        # Try each port in the range at most once
+        for _ in range(self._max_port - self._min_port + 1):
+            with self._lock:
+                if not self._free_ports:
+                    break
+                port = self._free_ports.popleft()
+
+            # Viser silently falls back to the next port if the requested one is taken,
+            # so check that the port isn't held by some other process first.
             try:
-                # Check if port is available by attempting to bind to it
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                     s.bind(("127.0.0.1", port))
-                    # Port is available, create server with this port
-                    server = viser.ViserServer(port=port)
-                    self._server_from_session_hash[server_id] = server
-                    self._last_port = port
-                    return server
             except OSError:
-                # Port is in use, try the next one
+                # Port is in use, put it back and try the next one
+                with self._lock:
+                    self._free_ports.append(port)
+                continue
+
+            # Port is available, create server with this port. This is slow, so it
+            # happens outside of the lock.
+            try:
+                server = viser.ViserServer(port=port)
+            except OSError:
+                # Server failed to start, put the port back and try the next one
+                with self._lock:
+                    self._free_ports.append(port)
                 continue
 
+            # Viser moves to the next port if it can't bind the requested one (e.g.,
+            # when another socket took it after our probe), so route to the port it
+            # actually bound.
+            actual_port = server.get_port()
+            with self._lock:
+                if actual_port != port:
+                    self._free_ports.append(port)
+                    if actual_port in self._free_ports:
+                        self._free_ports.remove(actual_port)
+                self._server_from_session_hash[server_id] = server
+                self._port_from_session_hash[server_id] = actual_port
+            return server
+
         # If we get here, no ports were available
         raise RuntimeError(
             f"No available local ports in range {self._min_port}-{self._max_port}"
@@ -234,4 +347,14 @@ class ViserProxyManager:
         Args:
             server_id: The unique identifier of the server to stop.
         """
-        self._server_from_session_hash.pop(server_id).stop()
+        with self._lock:
+            server = self._server_from_session_hash.pop(server_id)
+            port = self._port_from_session_hash.pop(server_id)
+        server.stop()
+
+        # Only release the port once the server has stopped listening on it. Ports
+        # outside of the configured range (e.g., from _VISER_PORT_OVERRIDE) aren't
+        # ours to allocate.
+        if self._min_port <= port <= self._max_port:
+            with self._lock:
+                self._free_ports.append(port)